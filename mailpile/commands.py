@@ -1,14 +1,18 @@
 # These are the Mailpile commands, the public "API" we expose for searching,
 # tagging and editing e-mail.
 #
+import collections
 import copy
 import datetime
+import hashlib
 import json
 import os
 import os.path
 import random
 import re
 import shlex
+import shutil
+import signal
 import socket
 import subprocess
 import sys
@@ -16,7 +20,6 @@ import traceback
 import threading
 import time
 import unicodedata
-import webbrowser
 
 import mailpile.util
 import mailpile.ui
@@ -27,6 +30,7 @@ from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
 from mailpile.mailboxes import IsMailbox
 from mailpile.mailutils import AddressHeaderParser, ClearParseCache
+from mailpile.mailutils import MBX_ID_LEN
 from mailpile.mailutils import ExtractEmails, ExtractEmailAndName, Email
 from mailpile.postinglist import GlobalPostingList
 from mailpile.safe_popen import MakePopenUnsafe, MakePopenSafe
@@ -36,6 +40,81 @@ from mailpile.vcard import AddressInfo
 from mailpile.vfs import vfs
 
 
+# Plain module-level aliases for the msg_info fields SearchResults reads
+# over and over; cheaper than a MailIndex attribute lookup every time.
+_M_MID = MailIndex.MSG_MID
+_M_ID = MailIndex.MSG_ID
+_M_DATE = MailIndex.MSG_DATE
+_M_FROM = MailIndex.MSG_FROM
+_M_TO = MailIndex.MSG_TO
+_M_CC = MailIndex.MSG_CC
+_M_KB = MailIndex.MSG_KB
+_M_SUBJECT = MailIndex.MSG_SUBJECT
+_M_TAGS = MailIndex.MSG_TAGS
+_M_REPLIES = MailIndex.MSG_REPLIES
+_M_THREAD_MID = MailIndex.MSG_THREAD_MID
+
+# Reused by CommandResult.as_text, so we don't construct a fresh encoder
+# for every result we print.
+_TEXT_JSON = json.JSONEncoder(indent=4, sort_keys=True,
+                              default=mailpile.util.json_helper)
+_ERROR_JSON = json.JSONEncoder(indent=4,
+                               default=mailpile.util.json_helper)
+
+# Arguments made only of these characters (separated by the whitespace
+# shlex splits on) tokenize the same with or without shlex.
+_SIMPLE_ARG_RE = re.compile(r'^[\w./@=:+,\-]+(?:[ \t\r\n]+[\w./@=:+,\-]+)*$',
+                            re.UNICODE)
+
+
+_HTTPD = None
+
+
+def _httpd():
+    # mailpile.httpd imports this module (via urlmap), so we can't import
+    # it at the top; instead we do it once, the first time it is needed.
+    global _HTTPD
+    if _HTTPD is None:
+        import mailpile.httpd
+        _HTTPD = mailpile.httpd
+    return _HTTPD
+
+
+class _LazyDict(dict):
+    """
+    A dict which is populated by calling loader() the first time anything
+    looks inside it, so callers which never do skip the work.
+
+    Only the dict methods listed below trigger the load; dict(x), the C
+    JSON encoder and other code reading the raw storage will see an empty
+    dict, so this is only handed to the template renderer.
+    """
+    def __init__(self, loader):
+        dict.__init__(self)
+        self._loader = loader
+
+    def _load(self):
+        if self._loader is not None:
+            loader, self._loader = self._loader, None
+            dict.update(self, loader())
+        return self
+
+
+def _lazy_dict_method(method):
+    def loaded(self, *args, **kwargs):
+        return method(self._load(), *args, **kwargs)
+    loaded.__name__ = method.__name__
+    return loaded
+
+
+for _name in ('__getitem__', '__contains__', '__iter__', '__len__',
+              '__eq__', '__ne__', '__repr__', 'get', 'keys', 'values',
+              'items', 'iterkeys', 'itervalues', 'iteritems', 'has_key',
+              'copy', 'pop', 'setdefault', 'update'):
+    setattr(_LazyDict, _name, _lazy_dict_method(getattr(dict, _name)))
+del _name
+
+
 class Command(object):
     """Generic command object all others inherit from"""
     SYNOPSIS = (None,     # CLI shortcode, e.g. A:
@@ -74,7 +153,32 @@ class Command(object):
     HTTP_STRICT_VARS = True
     HTTP_AUTH_REQUIRED = True
 
+    # Shared by all commands: (path, type, template) -> template path
+    _TEMPLATE_PATH_CACHE = {}
+
     class CommandResult:
+        # Renderer method names; bound lazily by as_() rather than building
+        # a dict of bound methods for every result.
+        _RENDERERS = {
+            'json': 'as_json',
+            'html': 'as_html',
+            'text': 'as_text',
+            'css': 'as_css',
+            'csv': 'as_csv',
+            'rss': 'as_rss',
+            'xml': 'as_xml',
+            'txt': 'as_txt',
+            'js': 'as_js'
+        }
+
+        # How many times a cachable command's template must be rendered
+        # before the rendering is memoized on the result.
+        MEMO_WEIGHT = 6
+
+        # (command cache_id, render_id) -> times rendered without being
+        # memoized; shared by all results.
+        _RENDER_WEIGHTS = {}
+
         def __init__(self, command_obj, session,
                      command_name, doc, result, status, message,
                      template_id=None, kwargs={}, error_info={}):
@@ -90,18 +194,14 @@ class Command(object):
             self.error_info = {}
             self.error_info.update(error_info)
             self.message = message
-            self.rendered = {}
-            self.renderers = {
-                'json': self.as_json,
-                'html': self.as_html,
-                'text': self.as_text,
-                'css': self.as_css,
-                'csv': self.as_csv,
-                'rss': self.as_rss,
-                'xml': self.as_xml,
-                'txt': self.as_txt,
-                'js': self.as_js
-            }
+            self._rendered = None
+
+        def _get_rendered(self):
+            if self._rendered is None:
+                self._rendered = {}
+            return self._rendered
+
+        rendered = property(_get_rendered)
 
         def __nonzero__(self):
             return (self.result and True or False)
@@ -109,11 +209,13 @@ class Command(object):
         def as_(self, what, *args, **kwargs):
             if args or kwargs:
                 # Args render things un-cacheable.
-                return self.renderers.get(what)(*args, **kwargs)
+                return getattr(self, self._RENDERERS[what])(*args, **kwargs)
 
-            if what not in self.rendered:
-                self.rendered[what] = self.renderers.get(what, self.as_text)()
-            return self.rendered[what]
+            rendered = self.rendered
+            if what not in rendered:
+                renderer = getattr(self, self._RENDERERS.get(what, 'as_text'))
+                rendered[what] = renderer()
+            return rendered[what]
 
         def as_text(self):
             if isinstance(self.result, bool):
@@ -121,13 +223,11 @@ class Command(object):
                                     self.message or self.doc)
                 if not self.result and self.error_info:
                     return '%s\n%s' % (happy,
-                        json.dumps(self.error_info, indent=4,
-                                   default=mailpile.util.json_helper))
+                                        _ERROR_JSON.encode(self.error_info))
                 else:
                     return happy
             elif isinstance(self.result, (dict, list, tuple)):
-                return json.dumps(self.result, indent=4, sort_keys=True,
-                    default=mailpile.util.json_helper)
+                return _TEXT_JSON.encode(self.result)
             else:
                 return unicode(self.result)
 
@@ -135,18 +235,22 @@ class Command(object):
 
         __unicode__ = lambda self: self.as_text()
 
-        def as_dict(self):
+        def _state(self):
             from mailpile.urlmap import UrlMap
             um = UrlMap(self.session)
+            return {
+                'command_url': um.ui_url(self.command_obj),
+                'context_url': um.context_url(self.command_obj),
+                'query_args': self.command_obj.state_as_query_args(),
+                'cache_id': self.command_obj.cache_id(),
+                'context': self.command_obj.context or ''
+            }
+
+        def as_dict(self, lazy_state=False):
             rv = {
                 'command': self.command_name,
-                'state': {
-                    'command_url': um.ui_url(self.command_obj),
-                    'context_url': um.context_url(self.command_obj),
-                    'query_args': self.command_obj.state_as_query_args(),
-                    'cache_id': self.command_obj.cache_id(),
-                    'context': self.command_obj.context or ''
-                },
+                'state': (_LazyDict(self._state) if lazy_state
+                          else self._state()),
                 'status': self.status,
                 'message': self.message,
                 'result': self.result,
@@ -199,27 +303,52 @@ class Command(object):
 
         def as_template(self, ttype,
                         mode=None, wrap_in_json=False, template=None):
-            cache_id = ''.join(('j' if wrap_in_json else '', ttype,
-                                '/' if template else '', template or '',
-                                ':', mode or 'full'))
+            render_id = ''.join((ttype,
+                                 '/' if template else '', template or '',
+                                 ':', mode or 'full'))
+            cache_id = ('j' + render_id) if wrap_in_json else render_id
             if cache_id in self.rendered:
                 return self.rendered[cache_id]
             tpath = self.command_obj.template_path(
                 ttype, template_id=self.template_id, template=template)
 
-            data = self.as_dict()
+            # Many templates never look at the state, so only work it out
+            # if one does.
+            data = self.as_dict(lazy_state=True)
             data['title'] = self.message
             data['render_mode'] = mode or 'full'
 
-            rendering = self.session.ui.render_web(self.session.config,
-                                                   [tpath], data)
+            # The JSON-wrapped and plain variants render the same template
+            # from the same data, so whichever comes second reuses it.
+            rendering = self.rendered.get(render_id)
+            if rendering is None:
+                rendering = self.session.ui.render_web(self.session.config,
+                                                       [tpath], data)
+                self.rendered[render_id] = rendering
             if wrap_in_json:
                 data['result'] = rendering
-                self.rendered[cache_id] = self.session.ui.render_json(data)
+                return self._memoize(cache_id,
+                                     self.session.ui.render_json(data))
             else:
-                self.rendered[cache_id] = rendering
-
-            return self.rendered[cache_id]
+                return rendering
+
+        def _memoize(self, render_id, rendering):
+            # Results of cachable commands can live for a long time, so we
+            # only hang on to a second, JSON-wrapped copy of a rendering
+            # once it has been asked for a few times.
+            command_id = self.command_obj.cache_id()
+            if command_id:
+                weights = self._RENDER_WEIGHTS
+                key = (command_id, render_id)
+                weight = weights.get(key, 0) + 1
+                if weight < self.MEMO_WEIGHT:
+                    if len(weights) > 4096:
+                        weights.clear()
+                    weights[key] = weight
+                    return rendering
+                weights.pop(key, None)
+            self.rendered[render_id] = rendering
+            return rendering
 
     def __init__(self, session, name=None, arg=None, data=None, async=False):
         self.session = session
@@ -231,13 +360,18 @@ class Command(object):
         self.error_info = {}
         self.result = None
         self.run_async = async
+        self._cache_id = None
+        self._sqa = None
         if type(arg) in (type(list()), type(tuple())):
             self.args = tuple(arg)
         elif arg:
             if self.SPLIT_ARG is True:
                 try:
-                    self.args = tuple([a.decode('utf-8') for a in
-                                       shlex.split(arg.encode('utf-8'))])
+                    if _SIMPLE_ARG_RE.match(arg):
+                        self.args = tuple(unicode(arg).split())
+                    else:
+                        self.args = tuple([a.decode('utf-8') for a in
+                                           shlex.split(arg.encode('utf-8'))])
                 except (ValueError, UnicodeEncodeError, UnicodeDecodeError):
                     raise UsageError(_('Failed to parse arguments'))
             else:
@@ -249,21 +383,37 @@ class Command(object):
         self._create_event()
 
     def state_as_query_args(self):
-        args = {}
-        if self.args:
-            args['arg'] = self._sloppy_copy(self.args)
-        args.update(self._sloppy_copy(self.data))
-        return args
+        # Our args and data do not change after construction, so the
+        # (sloppy, deep) copy only needs to be made once; refresh() resets.
+        if self._sqa is None:
+            args = {}
+            if self.args:
+                args['arg'] = self._sloppy_copy(self.args)
+            args.update(self._sloppy_copy(self.data))
+            self._sqa = args
+        return self._sqa
 
     def cache_id(self, sqa=None):
         if self.COMMAND_CACHE_TTL < 1:
             return ''
+        if sqa is None and self._cache_id is not None:
+            return self._cache_id
         from mailpile.urlmap import UrlMap
-        args = sorted(list((sqa or self.state_as_query_args()).iteritems()))
+        # Feed the hash one argument at a time, rather than building a
+        # (potentially huge) string representation of the whole lot.
+        digest = hashlib.md5()
+        for key, val in sorted((sqa or self.state_as_query_args()).iteritems()):
+            digest.update(repr(key))
+            digest.update('=')
+            digest.update(repr(val))
+            digest.update('\0')
         # The replace() stuff makes these usable as CSS class IDs
-        return ('%s-%s' % (UrlMap(self.session).ui_url(self),
-                           md5_hex(str(args))
-                           )).replace('/', '-').replace('.', '-')
+        cache_id = ('%s-%s' % (UrlMap(self.session).ui_url(self),
+                               digest.hexdigest()
+                               )).replace('/', '-').replace('.', '-')
+        if sqa is None:
+            self._cache_id = cache_id
+        return cache_id
 
     def cache_requirements(self, result):
         raise NotImplementedError('Cachable commands should override this, '
@@ -285,7 +435,16 @@ class Command(object):
                 self._ignore_exception()
 
     def template_path(self, ttype, template_id=None, template=None):
-        path_parts = (template_id or self.SYNOPSIS[2] or 'command').split('/')
+        key = (template_id or self.SYNOPSIS[2] or 'command', ttype, template)
+        tpath = self._TEMPLATE_PATH_CACHE.get(key)
+        if tpath is None:
+            if len(self._TEMPLATE_PATH_CACHE) > 256:
+                Command._TEMPLATE_PATH_CACHE = {}
+            tpath = self._TEMPLATE_PATH_CACHE[key] = self._template_path(*key)
+        return tpath
+
+    def _template_path(self, path, ttype, template):
+        path_parts = path.split('/')
         if template in (None, ttype, 'as.' + ttype):
             path_parts.append('index')
         else:
@@ -370,26 +529,27 @@ class Command(object):
 
     def _choose_messages(self, words, allow_ephemeral=False):
         msg_ids = set()
-        all_words = []
-        for word in words:
-            all_words.extend(word.split(','))
+        index_len = None
+        all_words = [w for word in words for w in word.split(',')]
         for what in all_words:
             if what.lower() == 'these':
                 if self.session.displayed:
                     b = self.session.displayed['stats']['start'] - 1
                     c = self.session.displayed['stats']['count']
-                    msg_ids |= set(self.session.results[b:b + c])
+                    msg_ids.update(self.session.results[b:b + c])
                 else:
                     self.session.ui.warning(_('No results to choose from!'))
             elif what.lower() in ('all', '!all', '=!all'):
                 if self.session.results:
-                    msg_ids |= set(self.session.results)
+                    msg_ids.update(self.session.results)
                 else:
                     self.session.ui.warning(_('No results to choose from!'))
             elif what.startswith('='):
                 try:
                     msg_id = int(what.replace('=', ''), 36)
-                    if msg_id >= 0 and msg_id < len(self._idx().INDEX):
+                    if index_len is None:
+                        index_len = len(self._idx().INDEX)
+                    if msg_id >= 0 and msg_id < index_len:
                         msg_ids.add(msg_id)
                     else:
                         self.session.ui.warning((_('No such ID: %s')
@@ -403,7 +563,7 @@ class Command(object):
             elif '-' in what:
                 try:
                     b, e = what.split('-')
-                    msg_ids |= set(self.session.results[int(b) - 1:int(e)])
+                    msg_ids.update(self.session.results[int(b) - 1:int(e)])
                 except (ValueError, KeyError, IndexError, TypeError):
                     self.session.ui.warning(_('What message is %s?'
                                               ) % (what, ))
@@ -480,20 +640,28 @@ class Command(object):
 
     def _sloppy_copy(self, data, name=None):
         if name and 'pass' == name[:4]:
-            data = '(SUPPRESSED)'
-        def copy_value(v):
+            return u'(SUPPRESSED)'
+        # The common types are checked first, so we only fall back to the
+        # (expensive) encode-to-test-for-binary dance for exotic values.
+        if isinstance(data, unicode):
+            return data[:1024]
+        elif isinstance(data, str):
             try:
-                unicode(v).encode('utf-8')
-                return unicode(v)[:1024]
-            except (UnicodeEncodeError, UnicodeDecodeError):
+                return data.decode('ascii')[:1024]
+            except UnicodeDecodeError:
                 return '(BINARY DATA)'
-        if isinstance(data, (list, tuple)):
+        elif isinstance(data, (int, long, float, bool)):
+            return unicode(data)
+        elif isinstance(data, (list, tuple)):
             return [self._sloppy_copy(i, name=name) for i in data]
         elif isinstance(data, dict):
             return dict((k, self._sloppy_copy(v, name=k))
                         for k, v in data.iteritems())
-        else:
-            return copy_value(data)
+        try:
+            unicode(data).encode('utf-8')
+            return unicode(data)[:1024]
+        except (UnicodeEncodeError, UnicodeDecodeError):
+            return '(BINARY DATA)'
 
     def _create_event(self):
         private_data = {}
@@ -632,6 +800,7 @@ class Command(object):
                 return self._run(*args, **kwargs)
 
     def refresh(self):
+        self._cache_id = self._sqa = None
         self._create_event()
         return self._run_sync(False, *self._run_args, **self._run_kwargs)
 
@@ -651,12 +820,67 @@ class Command(object):
 
 ##[ Shared basic Search Result class]#########################################
 
+_B36_CACHE = {}
+
+
+def _b36_cached(number):
+    # The same e-mail and message IDs get encoded over and over again when
+    # rendering search results, so remember the most recent conversions.
+    try:
+        return _B36_CACHE[number]
+    except KeyError:
+        if len(_B36_CACHE) > 4096:
+            _B36_CACHE.clear()
+        rv = _B36_CACHE[number] = b36(number)
+        return rv
+
+
+_INT36_CACHE = {}
+
+
+def _int36_cached(mid):
+    # ...and the same goes for decoding them again.
+    try:
+        return _INT36_CACHE[mid]
+    except KeyError:
+        if len(_INT36_CACHE) > 4096:
+            _INT36_CACHE.clear()
+        rv = _INT36_CACHE[mid] = int(mid, 36)
+        return rv
+
+
+_LOWER_EMAIL_CACHE = {}
+
+
+def _lower_email(email):
+    # Lower-casing unicode is surprisingly slow, and the same few senders
+    # and recipients show up over and over again.
+    try:
+        return _LOWER_EMAIL_CACHE[email]
+    except KeyError:
+        if len(_LOWER_EMAIL_CACHE) > 8192:
+            _LOWER_EMAIL_CACHE.clear()
+        rv = _LOWER_EMAIL_CACHE[email] = email.lower()
+        return rv
+
+
+# The fields of a msg_info which SearchResults needs split or decoded.
+_ParsedMsgInfo = collections.namedtuple('_ParsedMsgInfo', (
+    'tags', 'to', 'cc', 'from_email', 'from_name', 'ts', 'kb'))
+
+_NAME_STRIP_RE = re.compile('["<>]')
+_SUBJECT_RE = re.compile('^(\\[[^\\]]{6})[^\\]]{3,}\\]\\s*')
+_COMPACT_COMMA_RE = re.compile(', *[^, \.]+, *')
+_COMPACT_DOTS_RE = re.compile(',,,+, *')
+_COMPACT_NAME_RE = re.compile('^[^, \.]+$')
+
+
 class SearchResults(dict):
 
     _NAME_TITLES = ('the', 'mr', 'ms', 'mrs', 'sir', 'dr', 'lord')
 
     def _name(self, sender, short=True, full_email=False):
-        words = re.sub('["<>]', '', sender).split()
+        words = _NAME_STRIP_RE.sub('', sender).split()
         nomail = [w for w in words if not '@' in w]
         if nomail:
             if short:
@@ -672,13 +896,8 @@ class SearchResults(dict):
 
     def _names(self, senders):
         if len(senders) > 1:
-            names = {}
-            for sender in senders:
-                sname = self._name(sender)
-                names[sname] = names.get(sname, 0) + 1
-            namelist = names.keys()
-            namelist.sort(key=lambda n: -names[n])
-            return ', '.join(namelist)
+            names = collections.Counter(self._name(s) for s in senders)
+            return ', '.join(n for n, c in names.most_common())
         if len(senders) < 1:
             return '(no sender)'
         if senders:
@@ -687,12 +906,30 @@ class SearchResults(dict):
 
     def _compact(self, namelist, maxlen):
         l = len(namelist)
+        parts = namelist.split(',')
+        names = [p.lstrip(' ') for p in parts]
+        if l > maxlen and all(_COMPACT_NAME_RE.match(n) for n in names[1:-1]):
+            # Every name in the middle is droppable, so we can work out how
+            # many _COMPACT_COMMA_RE would eat by arithmetic, in one pass.
+            dropped = 0
+            while l > maxlen and dropped < len(names) - 2:
+                dropped += 1
+                l -= (len(names[dropped]) +
+                      len(parts[dropped + 1]) - len(names[dropped + 1]))
+                if dropped == 1:
+                    l -= len(parts[1]) - len(names[1])
+            if dropped:
+                namelist = '%s%s%s' % (parts[0], ',' * (dropped + 1),
+                                       ','.join([names[dropped + 1]] +
+                                                parts[dropped + 2:]))
+            return _COMPACT_DOTS_RE.sub(' .. ', namelist, 1)
+
         while l > maxlen:
-            namelist = re.sub(', *[^, \.]+, *', ',,', namelist, 1)
+            namelist = _COMPACT_COMMA_RE.sub(',,', namelist, 1)
             if l == len(namelist):
                 break
             l = len(namelist)
-        namelist = re.sub(',,,+, *', ' .. ', namelist, 1)
+        namelist = _COMPACT_DOTS_RE.sub(' .. ', namelist, 1)
         return namelist
 
     TAG_TYPE_FLAG_MAP = {
@@ -707,27 +944,65 @@ class SearchResults(dict):
         'fwded': 'forwarded'
     }
 
-    def _metadata(self, msg_info):
+    def _parse_msg_info(self, msg_info):
+        """Split and decode the msg_info fields we use, just once"""
+        fe, fn = ExtractEmailAndName(msg_info[_M_FROM])
+        return _ParsedMsgInfo(
+            tags=tuple(filter(None, msg_info[_M_TAGS].split(','))),
+            to=tuple(filter(None, msg_info[_M_TO].split(','))),
+            cc=tuple(filter(None, msg_info[_M_CC].split(','))),
+            from_email=fe,
+            from_name=fn,
+            ts=long(msg_info[_M_DATE], 36),
+            kb=int(msg_info[_M_KB], 36))
+
+    def _prefetch(self, parsed_infos):
+        """Resolve the tags and sender vCards used by a batch of messages"""
+        config = self.idx.config
+        tags, vcards = self._prefetched['tags'], self._prefetched['vcards']
+        crypto = self._prefetched['crypto']
+        tids, senders = set(), set()
+        for parsed in parsed_infos:
+            tids.update(self._msg_tags(None, parsed=parsed))
+            senders.add(_lower_email(parsed.from_email))
+        for tid in tids:
+            if tid not in tags:
+                tag = tags[tid] = config.get_tag(tid)
+                # Tags which tell us about encryption or signatures
+                if tag.slug.startswith('mp_sig'):
+                    crypto[tid] = ('signature', tag.slug[7:])
+                elif tag.slug.startswith('mp_enc'):
+                    crypto[tid] = ('encryption', tag.slug[7:])
+        for email in senders:
+            if email not in vcards:
+                vcards[email] = config.vcards.get_vcard(email)
+        return self._prefetched
+
+    def _metadata(self, msg_info, prefetched=None, parsed=None):
         import mailpile.urlmap
         nz = lambda l: [v for v in l if v]
-        msg_ts = long(msg_info[MailIndex.MSG_DATE], 36)
+        parsed = parsed or self._parse_msg_info(msg_info)
+        msg_ts = parsed.ts
         msg_date = datetime.datetime.fromtimestamp(msg_ts)
 
-        fe, fn = ExtractEmailAndName(msg_info[MailIndex.MSG_FROM])
+        fe, fn = parsed.from_email, parsed.from_name
         f_info = self._address(e=fe, n=fn)
-        f_info['aid'] = (self._msg_addresses(msg_info, no_to=True, no_cc=True)
+        f_info['aid'] = (self._msg_addresses(msg_info, no_to=True, no_cc=True,
+                                             parsed=parsed)
                          or [''])[0]
         expl = {
-            'mid': msg_info[MailIndex.MSG_MID],
-            'id': msg_info[MailIndex.MSG_ID],
+            'mid': msg_info[_M_MID],
+            'id': msg_info[_M_ID],
             'timestamp': msg_ts,
             'from': f_info,
-            'to_aids': self._msg_addresses(msg_info, no_from=True, no_cc=True),
-            'cc_aids': self._msg_addresses(msg_info, no_from=True, no_to=True),
-            'msg_kb': int(msg_info[MailIndex.MSG_KB], 36),
-            'tag_tids': sorted(self._msg_tags(msg_info)),
-            'thread_mid': msg_info[MailIndex.MSG_THREAD_MID],
-            'subject': msg_info[MailIndex.MSG_SUBJECT],
+            'to_aids': self._msg_addresses(msg_info, no_from=True, no_cc=True,
+                                           parsed=parsed),
+            'cc_aids': self._msg_addresses(msg_info, no_from=True, no_to=True,
+                                           parsed=parsed),
+            'msg_kb': parsed.kb,
+            'tag_tids': sorted(self._msg_tags(msg_info, parsed=parsed)),
+            'thread_mid': msg_info[_M_THREAD_MID],
+            'subject': msg_info[_M_SUBJECT],
             'body': MailIndex.get_body(msg_info),
             'flags': {
             },
@@ -736,15 +1011,15 @@ class SearchResults(dict):
         }
 
         # Ephemeral messages do not have URLs
-        if '-' in msg_info[MailIndex.MSG_MID]:
+        if '-' in msg_info[_M_MID]:
             expl['flags'].update({
                 'ephemeral': True,
                 'draft': True,
             })
         else:
             expl['urls'] = {
-                'thread': self.urlmap.url_thread(msg_info[MailIndex.MSG_MID]),
-                'source': self.urlmap.url_source(msg_info[MailIndex.MSG_MID]),
+                'thread': self.urlmap.url_thread(msg_info[_M_MID]),
+                'source': self.urlmap.url_source(msg_info[_M_MID]),
             }
 
         # Support rich snippets
@@ -755,22 +1030,22 @@ class SearchResults(dict):
                 pass
 
         # Misc flags
-        sender_vcard = self.idx.config.vcards.get_vcard(fe.lower())
+        prefetched = prefetched or self._prefetch([parsed])
+        sender_vcard = prefetched['vcards'].get(_lower_email(fe))
         if sender_vcard:
             if sender_vcard.kind == 'profile':
                 expl['flags']['from_me'] = True
-        tag_types = [self.idx.config.get_tag(t).type for t in expl['tag_tids']]
+        tag_types = set(prefetched['tags'][t].type for t in expl['tag_tids'])
         for t in self.TAG_TYPE_FLAG_MAP:
             if t in tag_types:
                 expl['flags'][self.TAG_TYPE_FLAG_MAP[t]] = True
 
         # Check tags for signs of encryption or signatures
-        tag_slugs = [self.idx.config.get_tag(t).slug for t in expl['tag_tids']]
-        for t in tag_slugs:
-            if t.startswith('mp_sig'):
-                expl['crypto']['signature'] = t[7:]
-            elif t.startswith('mp_enc'):
-                expl['crypto']['encryption'] = t[7:]
+        crypto = prefetched['crypto']
+        for t in expl['tag_tids']:
+            if t in crypto:
+                what, state = crypto[t]
+                expl['crypto'][what] = state
 
         # Extra behavior for editable messages
         if 'draft' in expl['flags']:
@@ -784,71 +1059,107 @@ class SearchResults(dict):
         return expl
 
     def _msg_addresses(self, msg_info=None, addresses=[],
-                       no_from=False, no_to=False, no_cc=False):
+                       no_from=False, no_to=False, no_cc=False, parsed=None):
         cids = set()
+        email_ids = self.idx.EMAIL_IDS
 
         for ai in addresses:
-            try:
-                cids.add(b36(self.idx.EMAIL_IDS[ai.address.lower()]))
-            except KeyError:
-                cids.add(b36(self.idx._add_email(ai.address, name=ai.fn)))
+            eid = email_ids.get(_lower_email(ai.address))
+            if eid is None:
+                eid = self.idx._add_email(ai.address, name=ai.fn)
+            cids.add(_b36_cached(eid))
 
         if msg_info:
+            parsed = parsed or self._parse_msg_info(msg_info)
             if not no_to:
-                to = [t for t in msg_info[MailIndex.MSG_TO].split(',') if t]
-                cids |= set(to)
+                cids.update(parsed.to)
             if not no_cc:
-                cc = [t for t in msg_info[MailIndex.MSG_CC].split(',') if t]
-                cids |= set(cc)
+                cids.update(parsed.cc)
             if not no_from:
-                fe, fn = ExtractEmailAndName(msg_info[MailIndex.MSG_FROM])
+                fe, fn = parsed.from_email, parsed.from_name
                 if fe:
-                    try:
-                        cids.add(b36(self.idx.EMAIL_IDS[fe.lower()]))
-                    except KeyError:
-                        cids.add(b36(self.idx._add_email(fe, name=fn)))
+                    eid = email_ids.get(_lower_email(fe))
+                    if eid is None:
+                        eid = self.idx._add_email(fe, name=fn)
+                    cids.add(_b36_cached(eid))
 
-        return sorted(list(cids))
+        return sorted(cids)
 
     def _address(self, cid=None, e=None, n=None):
         if cid and not (e and n):
-            e, n = ExtractEmailAndName(self.idx.EMAILS[int(cid, 36)])
-        vcard = self.session.config.vcards.get_vcard(e)
+            e, n = ExtractEmailAndName(self.idx.EMAILS[_int36_cached(cid)])
+        vcard = self._vcard(e)
         if vcard and '@' in n:
             n = vcard.fn
         return AddressInfo(e, n, vcard=vcard)
 
-    def _msg_tags(self, msg_info):
-        tids = [t for t in msg_info[MailIndex.MSG_TAGS].split(',')
-                if t and t in self.session.config.tags]
-        return tids
+    def _vcard(self, email):
+        # Shares the per-page vCard cache filled in by _prefetch
+        vcards = self._prefetched['vcards']
+        email = _lower_email(email)
+        try:
+            return vcards[email]
+        except KeyError:
+            vcard = vcards[email] = self.session.config.vcards.get_vcard(email)
+            return vcard
+
+    def _msg_tags(self, msg_info, parsed=None):
+        tags = self.session.config.tags
+        if parsed is not None:
+            return [t for t in parsed.tags if t in tags]
+        return [t for t in msg_info[_M_TAGS].split(',')
+                if t and t in tags]
 
     def _tag(self, tid, attributes={}):
-        return dict_merge(self.session.config.get_tag_info(tid), attributes)
+        try:
+            info = self._tag_info[tid]
+        except KeyError:
+            info = self._tag_info[tid] = self.session.config.get_tag_info(tid)
+        return dict_merge(info, attributes)
+
+    def _msg_info(self, mid):
+        try:
+            return self._msg_info_cache[mid]
+        except KeyError:
+            info = self._msg_info_cache[mid] = self.idx.get_msg_at_idx_pos(
+                _int36_cached(mid))
+            return info
 
     def _thread(self, thread_mid):
-        msg_info = self.idx.get_msg_at_idx_pos(int(thread_mid, 36))
-        thread = [i for i in msg_info[MailIndex.MSG_REPLIES].split(',') if i]
+        msg_info = self._msg_info(thread_mid)
+        thread = [i for i in msg_info[_M_REPLIES].split(',') if i]
 
         # FIXME: This is a hack, the indexer should just keep things
         #        in the right order on rescan. Fixing threading is a bigger
         #        problem though, so we do this for now.
-        def thread_sort_key(idx):
-            info = self.idx.get_msg_at_idx_pos(int(thread_mid, 36))
-            return int(info[self.idx.MSG_DATE], 36)
-        thread.sort(key=thread_sort_key)
+        if len(thread) < 2:
+            return thread
+        decorated = [(long(self._msg_info(mid)[_M_DATE], 36), i, mid)
+                     for i, mid in enumerate(thread)]
+        decorated.sort()
 
-        return thread
+        return [mid for ts, i, mid in decorated]
 
     WANT_MSG_TREE = ('attachments', 'html_parts', 'text_parts', 'header_list',
                      'editing_strings', 'crypto')
     PRUNE_MSG_TREE = ('headers', )  # Added by editing_strings
 
     def _prune_msg_tree(self, tree):
-        for k in tree.keys():
-            if k not in self.WANT_MSG_TREE or k in self.PRUNE_MSG_TREE:
-                del tree[k]
-        return tree
+        return dict((k, tree[k]) for k in self.WANT_MSG_TREE
+                    if k in tree and k not in self.PRUNE_MSG_TREE)
+
+    def _header_aids(self, header):
+        # Messages in a thread tend to share their address headers, so
+        # only run each distinct one through the (slow) parser once.
+        if not header:
+            return []
+        try:
+            return list(self._parsed_headers[header])
+        except KeyError:
+            cids = self._msg_addresses(
+                addresses=AddressHeaderParser(unicode_data=header))
+            self._parsed_headers[header] = tuple(cids)
+            return cids
 
     def _message(self, email):
         tree = email.get_message_tree(want=(email.WANT_MSG_TREE_PGP +
@@ -859,9 +1170,7 @@ class SearchResults(dict):
         if editing_strings:
             for key in ('from', 'to', 'cc', 'bcc'):
                 if key in editing_strings:
-                    cids = self._msg_addresses(
-                        addresses=AddressHeaderParser(
-                            unicode_data=editing_strings[key]))
+                    cids = self._header_aids(editing_strings[key])
                     editing_strings['%s_aids' % key] = cids
                     for cid in cids:
                         if cid not in self['data']['addresses']:
@@ -880,6 +1189,10 @@ class SearchResults(dict):
         self.emails = emails
         self.idx = idx
         self.urlmap = mailpile.urlmap.UrlMap(self.session)
+        self._prefetched = {'tags': {}, 'vcards': {}, 'crypto': {}}
+        self._msg_info_cache = {}
+        self._parsed_headers = {}
+        self._tag_info = {}
 
         results = self.results = results or session.results or []
 
@@ -892,7 +1205,7 @@ class SearchResults(dict):
             start = 0
 
         try:
-            threads = [b36(r) for r in results[start:start + num]]
+            threads = [_b36_cached(r) for r in results[start:start + num]]
         except TypeError:
             results = threads = []
             start = end = 0
@@ -914,6 +1227,11 @@ class SearchResults(dict):
             'message_ids': [],
             'thread_ids': threads,
         })
+        if suppress_data and not emails:
+            # Only the summary and stats were asked for; don't bother
+            # resolving the searched-for tags.
+            return
+
         if 'tags' in self.session.config:
             search_tags = [idx.config.get_tag(t.split(':')[1], {})
                            for t in session.searched
@@ -945,40 +1263,60 @@ class SearchResults(dict):
                 if tid not in th:
                     th[tid] = self._tag(tid, {'searched': True})
 
-        idxs = results[start:start + num]
-        while idxs:
-            idx_pos = idxs.pop(0)
-            msg_info = idx.get_msg_at_idx_pos(idx_pos)
-            self.add_msg_info(b36(idx_pos), msg_info,
-                              full_threads=full_threads, idxs=idxs)
+        # Work in batches: the page itself, then the thread members it
+        # pulled in, and so on. Each batch is de-duplicated against what
+        # we already have and its tags and senders are prefetched at once.
+        metadata = self['data']['metadata']
+        batch = results[start:start + num]
+        while batch:
+            mids, infos, seen = [], [], set()
+            for idx_pos in batch:
+                mid = _b36_cached(idx_pos)
+                if mid not in metadata and mid not in seen:
+                    seen.add(mid)
+                    mids.append(mid)
+                    infos.append(self._msg_info(mid))
+            parsed = [self._parse_msg_info(msg_info) for msg_info in infos]
+            prefetched = self._prefetch(parsed)
+
+            batch = []
+            for mid, msg_info, p in zip(mids, infos, parsed):
+                self.add_msg_info(mid, msg_info,
+                                  full_threads=full_threads, idxs=batch,
+                                  parsed=p, prefetched=prefetched)
 
         if emails and len(emails) == 1:
-            self['summary'] = emails[0].get_msg_info(MailIndex.MSG_SUBJECT)
+            self['summary'] = emails[0].get_msg_info(_M_SUBJECT)
 
         for e in emails or []:
             self.add_email(e)
 
-    def add_msg_info(self, mid, msg_info, full_threads=False, idxs=None):
+    def add_msg_info(self, mid, msg_info, full_threads=False, idxs=None,
+                     parsed=None, prefetched=None):
+        parsed = parsed or self._parse_msg_info(msg_info)
+
         # Populate data.metadata
-        self['data']['metadata'][mid] = self._metadata(msg_info)
+        self['data']['metadata'][mid] = self._metadata(msg_info,
+                                                       prefetched=prefetched,
+                                                       parsed=parsed)
 
         # Populate data.thread
         thread_mid = msg_info[self.idx.MSG_THREAD_MID]
         if thread_mid not in self['data']['threads']:
             thread = self._thread(thread_mid)
             self['data']['threads'][thread_mid] = thread
-            if full_threads and idxs:
-                idxs.extend([int(t, 36) for t in thread
+            if full_threads and idxs is not None:
+                idxs.extend([_int36_cached(t) for t in thread
                              if t not in self['data']['metadata']])
 
         # Populate data.person
-        for cid in self._msg_addresses(msg_info):
+        for cid in self._msg_addresses(msg_info, parsed=parsed):
             if cid not in self['data']['addresses']:
                 self['data']['addresses'][cid] = self._address(cid=cid)
 
         # Populate data.tag
         if 'tags' in self.session.config:
-            for tid in self._msg_tags(msg_info):
+            for tid in self._msg_tags(msg_info, parsed=parsed):
                 if tid not in self['data']['tags']:
                     self['data']['tags'][tid] = self._tag(tid,
                                                           {"searched": False})
@@ -1009,8 +1347,16 @@ class SearchResults(dict):
                              end=stats['start'] - 1)
 
     def _fix_width(self, text, width):
+        text = unicode(text)
+        try:
+            # Plain ASCII is one column per character, so we can just
+            # slice and pad instead of measuring each character.
+            text.encode('ascii')
+            return text[:max(0, width)].ljust(width)
+        except UnicodeEncodeError:
+            pass
         chars = []
-        for c in unicode(text):
+        for c in text:
             cwidth = 2 if (unicodedata.east_asian_width(c) in 'WF') else 1
             if cwidth <= width:
                 chars.append(c)
@@ -1025,6 +1371,7 @@ class SearchResults(dict):
         from mailpile.www.jinjaextensions import MailpileCommand as JE
         clen = max(3, len('%d' % len(self.session.results)))
         cfmt = '%%%d.%ds' % (clen, clen)
+        tfmt = cfmt + ' %s%s%s%s'
 
         term_width = self.session.ui.term.max_width()
         fs_width = int((22 + 53) * (term_width / 79.0))
@@ -1034,34 +1381,68 @@ class SearchResults(dict):
         text = []
         count = self['stats']['start']
         expand_ids = [e.msg_idx_pos for e in (self.emails or [])]
-        addresses = self.get('data', {}).get('addresses', {})
+        expand_pos = {}
+        for i, idx_pos in enumerate(expand_ids):
+            expand_pos.setdefault(idx_pos, i)
+        data = self.get('data', {})
+        addresses = data.get('addresses', {})
+        metadata = data.get('metadata', {})
+        all_tags = data.get('tags', {})
+        threads = data.get('threads', {})
+        messages = data.get('messages', {})
+
+        def gg(pos):
+            return (pos < 10) and pos or '>'
+        thread_positions = {}
+        elapsed = {}
+        tag_labels = {}
+        from_columns = {}
+
+        # The tags are shared by all the rows, so classify them just once.
+        visible_names, unread_tids = {}, set()
+        sig_tids, enc_tids = set(), set()
+        for tid, t in all_tags.iteritems():
+            if (not t.get('searched', False) and t.get('label', True)
+                    and t.get('display', '') != 'invisible'):
+                visible_names[tid] = t['name']
+            if t.get('type') == 'unread':
+                unread_tids.add(tid)
+            # FIXME: this is a bit ugly, but useful for development
+            if 'none' not in t['slug']:
+                if t['slug'].startswith('mp_sig'):
+                    sig_tids.add(tid)
+                if t['slug'].startswith('mp_enc'):
+                    enc_tids.add(tid)
 
         for mid in self['thread_ids']:
-            m = self['data']['metadata'][mid]
-            tags = [self['data']['tags'][t] for t in m['tag_tids']]
-            tag_names = [t['name'] for t in tags
-                         if not t.get('searched', False)
-                         and t.get('label', True)
-                         and t.get('display', '') != 'invisible']
-            tag_new = [t for t in tags if t.get('type') == 'unread']
-            tag_names.sort()
-            msg_meta = tag_names and ('  (' + '('.join(tag_names)) or ''
-
-            # FIXME: this is a bit ugly, but useful for development
-            es = ['', '']
-            for t in [t['slug'] for t in tags]:
-                if t.startswith('mp_enc') and 'none' not in t:
-                    es[1] = 'E'
-                if t.startswith('mp_sig') and 'none' not in t:
-                    es[0] = 'S'
-            es = ''.join([e for e in es if e])
+            m = metadata[mid]
+            tids = m['tag_tids']
+            # Many rows carry the same combination of tags
+            tids_key = tuple(tids)
+            try:
+                msg_meta = tag_labels[tids_key]
+            except KeyError:
+                tag_names = sorted(visible_names[t] for t in tids
+                                   if t in visible_names)
+                msg_meta = tag_names and ('  (' + '('.join(tag_names)) or ''
+                tag_labels[tids_key] = msg_meta
+            tag_new = unread_tids.intersection(tids)
+
+            es = ((sig_tids.intersection(tids) and 'S' or '') +
+                  (enc_tids.intersection(tids) and 'E' or ''))
             if es:
                 msg_meta = (msg_meta or '  ') + ('[%s]' % es)
             elif msg_meta:
                 msg_meta += ')'
             else:
                 msg_meta += '  '
-            msg_meta += elapsed_datetime(m['timestamp'])
+            # Rows from the same minute share their relative date
+            ts_minute = m['timestamp'] // 60
+            try:
+                msg_meta += elapsed[ts_minute]
+            except KeyError:
+                elapsed[ts_minute] = elapsed_datetime(ts_minute * 60)
+                msg_meta += elapsed[ts_minute]
 
             from_info = (m['from'].get('fn') or m['from'].get('email')
                          or '(anonymous)')
@@ -1077,34 +1458,40 @@ class SearchResults(dict):
                     from_info = '%s..@%s' % (e[0], d)
 
             if not expand_ids:
-                def gg(pos):
-                    return (pos < 10) and pos or '>'
-                thread = [m['thread_mid']]
-                thread += self['data']['threads'][m['thread_mid']]
-                if m['mid'] not in thread:
-                    thread.append(m['mid'])
-                pos = thread.index(m['mid']) + 1
+                try:
+                    positions, thread_len = thread_positions[m['thread_mid']]
+                except KeyError:
+                    thread = [m['thread_mid']] + threads[m['thread_mid']]
+                    positions = {}
+                    for i, t_mid in enumerate(thread):
+                        positions.setdefault(t_mid, i + 1)
+                    thread_len = len(thread)
+                    thread_positions[m['thread_mid']] = (positions, thread_len)
+                if m['mid'] in positions:
+                    pos = positions[m['mid']]
+                else:
+                    pos = thread_len = thread_len + 1
                 if pos > 1:
                     from_info = '%s>%s' % (gg(pos-1), from_info)
                 else:
                     from_info = '  ' + from_info
-                if pos < len(thread):
-                    from_info = '%s>%s' % (from_info[:20], gg(len(thread)-pos))
+                if pos < thread_len:
+                    from_info = '%s>%s' % (from_info[:20], gg(thread_len-pos))
 
-            subject = re.sub('^(\\[[^\\]]{6})[^\\]]{3,}\\]\\s*', '\\1..] ',
-                             JE._nice_subject(m))
+            subject = _SUBJECT_RE.sub('\\1..] ', JE._nice_subject(m))
             subject_width = max(1, s_width - (clen + len(msg_meta)))
             subject = self._fix_width(subject, subject_width)
-            from_info = self._fix_width(from_info, f_width)
+            try:
+                from_info = from_columns[from_info]
+            except KeyError:
+                from_info = from_columns[from_info] = self._fix_width(
+                    from_info, f_width)
 
-            #sfmt = '%%s%%s' % (subject_width, subject_width)
-            #ffmt = ' %%s%%s' % (f_width, f_width)
-            tfmt = cfmt + ' %s%s%s%s'
             text.append(tfmt % (count, from_info, tag_new and '*' or ' ',
                                 subject, msg_meta))
 
-            if mid in self['data'].get('messages', {}):
-                exp_email = self.emails[expand_ids.index(int(mid, 36))]
+            if mid in messages:
+                exp_email = self.emails[expand_pos[_int36_cached(mid)]]
                 msg_tree = exp_email.get_message_tree()
                 text.append('-' * term_width)
                 text.append(exp_email.get_editing_string(msg_tree,
@@ -1185,7 +1572,13 @@ class Rescan(Command):
 
         msg_idxs = self._choose_messages(args)
         if msg_idxs:
-            for msg_idx_pos in msg_idxs:
+            # Group the work by mailbox, so each one is opened and read
+            # through in one go instead of us hopping back and forth.
+            def mailbox_order(msg_idx_pos):
+                ptrs = idx.get_msg_at_idx_pos(msg_idx_pos)[idx.MSG_PTRS]
+                return (ptrs[:MBX_ID_LEN], msg_idx_pos)
+
+            for msg_idx_pos in sorted(msg_idxs, key=mailbox_order):
                 e = Email(idx, msg_idx_pos)
                 try:
                     session.ui.mark('Re-indexing %s' % e.msg_mid())
@@ -1414,6 +1807,8 @@ class BrowseOrLaunch(Command):
         http_url = ('http://%s:%s%s/' % sspec
                     ).replace('//0.0.0.0:', '//localhost:')
         try:
+            # Imported here: webbrowser probes $PATH for browsers on import
+            import webbrowser
             MakePopenUnsafe()
             webbrowser.open(http_url)
             return http_url
@@ -1621,17 +2016,16 @@ class ProgramStatus(Command):
 
         threads = threading.enumerate()
         for thread in threads:
-            try:
-                if hasattr(thread, 'lock'):
-                    locks.append([thread, 'lock', thread.lock])
-                if hasattr(thread, '_lock'):
-                    locks.append([thread, '_lock', thread._lock])
-                if locks and hasattr(locks[-1][-1], 'locked'):
-                    locks[-1][-1] = locks[-1][-1].locked()
-                elif locks and hasattr(locks[-1][-1], '_is_owned'):
-                    locks[-1][-1] = locks[-1][-1]._is_owned()
-            except AttributeError:
-                pass
+            for attr in ('lock', '_lock'):
+                lock = getattr(thread, attr, None)
+                if lock is None:
+                    continue
+                probe = (getattr(lock, 'locked', None) or
+                         getattr(lock, '_is_owned', None))
+                try:
+                    locks.append([thread, attr, probe() if probe else lock])
+                except AttributeError:
+                    pass
 
         import mailpile.auth
         import mailpile.httpd
@@ -1718,6 +2112,9 @@ class ListDir(Command):
         if not args:
             args = ['.']
 
+        config = self.session.config
+        show_hidden = ('-a' in flags)
+
         def lsf(f):
             afp = vfs.abspath(f)
             info = {'icon': '',
@@ -1730,13 +2127,13 @@ class ListDir(Command):
                     info['bytes'] = b
                 info.update(dict(('flag_%s' % unicode(k).lower(), True)
                                  for k in
-                                 vfs.getflags(afp, self.session.config)))
+                                 vfs.getflags(afp, config)))
                 return info
             except (OSError, IOError):
                 return info
         def ls(p):
             return [lsf(vfs.path_join(p, f)) for f in vfs.listdir(p)
-                    if '-a' in flags or f.raw_fp[:1] != '.']
+                    if show_hidden or f.raw_fp[:1] != '.']
 
         file_list = []
         for path in args:
@@ -1793,8 +2190,28 @@ class CatFile(Command):
             else:
                 return ''
 
+    COPY_CHUNK = 1024 * 1024
+
+    def _is_plaintext(self, fd):
+        # Scan for anything that could start an encrypted section; the
+        # check is deliberately looser than the line-based one used for
+        # decryption, so a false match just means taking the slow path.
+        from mailpile.crypto.streamer import PartialDecryptingStreamer as PDS
+        markers = (PDS.BEGIN_MED[:-1], PDS.BEGIN_MED2, PDS.BEGIN_PGP[:-1])
+        overlap = max(len(m) for m in markers)
+        tail = ''
+        while True:
+            data = fd.read(self.COPY_CHUNK)
+            if not data:
+                return True
+            data = tail + data
+            for m in markers:
+                if m in data:
+                    return False
+            tail = data[-overlap:]
+
     def command(self, args=None):
-        lines = []
+        buf = bytearray()
         files = list(args or self.args)
 
         if self.session.config.sys.lockdown:
@@ -1807,12 +2224,21 @@ class CatFile(Command):
                 return self._error(_('That file already exists: %s'
                                      ) % target)
             tfd = vfs.open(target, 'wb')
-            cb = lambda ll: [tfd.write(l) for l in ll]
+            cb = lambda ll: tfd.writelines(ll)
         else:
-            cb = lambda ll: lines.extend((l.decode('utf-8') for l in ll))
+            cb = lambda ll: buf.extend(''.join(ll))
 
         for fn in files:
             with vfs.open(fn, 'r') as fd:
+                if tfd:
+                    # Plain files can be copied in large chunks, without
+                    # iterating over every line in Python.
+                    plaintext = self._is_plaintext(fd)
+                    fd.seek(0)
+                    if plaintext:
+                        shutil.copyfileobj(fd, tfd, self.COPY_CHUNK)
+                        continue
+
                 def errors(where):
                     self.session.ui.error('Decrypt failed at %d' % where)
                 decrypt_and_parse_lines(fd, cb, self.session.config,
@@ -1824,8 +2250,16 @@ class CatFile(Command):
             return self._success(_('Dumped to %s: %s'
                                    ) % (target, ', '.join(files)))
         else:
+            # Decode once at the end, rather than line by line. Only split
+            # on '\n' like the file iterator did; unicode.splitlines()
+            # would also break on form feeds, \u2028 and so on.
+            lines = str(buf).decode('utf-8').split('\n')
+            last = lines.pop(-1)
+            lines = [l + '\n' for l in lines]
+            if last:
+                lines.append(last)
             return self._success(_('Dumped: %s') % ', '.join(files),
-                                   result=lines)
+                                 result=lines)
 
 
 ##[ Configuration commands ]###################################################
@@ -1847,7 +2281,7 @@ class ConfigSet(Command):
     }
 
     def command(self):
-        from mailpile.httpd import BLOCK_HTTPD_LOCK, Idle_HTTPD
+        httpd = _httpd()
 
         config = self.session.config
         args = list(self.args)
@@ -1865,17 +2299,27 @@ class ConfigSet(Command):
             # Make sure section exists
             ops.append((section, '!CREATE_SECTION'))
 
-        for var in self.data.keys():
+        rules = config.rules
+        section_has_slash = ('/' in section)
+        for var, vals in self.data.iteritems():
             if var in ('_section', '_method', 'context', 'csrf'):
                 continue
-            sep = '/' if ('/' in (section+var)) else '.'
-            svar = (section+sep+var) if section else var
-            parts = svar.split(sep)
-            if parts[0] in config.rules:
+            sep = '/' if (section_has_slash or '/' in var) else '.'
+            if section:
+                svar = section + sep + var
+                first = section.split(sep, 1)[0]
+            else:
+                svar = var
+                first = var.split(sep, 1)[0]
+            if first in rules:
                 if svar.endswith('[]'):
-                    ops.append((svar[:-2], json.dumps(self.data[var])))
+                    # Pass lists straight through, rather than encoding
+                    # them as JSON only to parse them again below.
+                    ops.append((svar[:-2], [
+                        (v.decode('utf-8') if isinstance(v, str) else v)
+                        for v in vals]))
                 else:
-                    ops.append((svar, self.data[var][0]))
+                    ops.append((svar, vals[0]))
             else:
                 raise ValueError(_('Invalid section or variable: %s') % var)
 
@@ -1891,12 +2335,13 @@ class ConfigSet(Command):
 
         # We don't have transactions really, but making sure the HTTPD
         # is idle (aside from this request) will definitely help.
-        with BLOCK_HTTPD_LOCK, Idle_HTTPD():
+        with httpd.BLOCK_HTTPD_LOCK, httpd.Idle_HTTPD():
             updated = {}
             for path, value in ops:
-                value = value.strip()
-                if value[:1] in ('{', '[') and value[-1:] in ( ']', '}'):
-                    value = json.loads(value)
+                if not isinstance(value, list):
+                    value = value.strip()
+                    if value[:1] in ('{', '[') and value[-1:] in (']', '}'):
+                        value = json.loads(value)
                 try:
                     try:
                         cfg, var = config.walk(path.strip(), parent=1)
@@ -1913,7 +2358,7 @@ class ConfigSet(Command):
                     raise ValueError('Could not set variable: %s' % path)
 
         if config.loaded_config:
-            self._background_save(config=True)
+            config.schedule_save(self.session)
 
         return self._success(_('Updated your settings'), result=updated)
 
@@ -1931,7 +2376,7 @@ class ConfigAdd(Command):
     IS_USER_ACTIVITY = True
 
     def command(self):
-        from mailpile.httpd import BLOCK_HTTPD_LOCK, Idle_HTTPD
+        httpd = _httpd()
 
         config = self.session.config
         ops = []
@@ -1939,10 +2384,11 @@ class ConfigAdd(Command):
         if config.sys.lockdown:
             return self._error(_('In lockdown, doing nothing.'))
 
-        for var in self.data.keys():
+        rules = config.rules
+        for var, vals in self.data.iteritems():
             parts = ('.' in var) and var.split('.') or var.split('/')
-            if parts[0] in config.rules:
-                ops.append((var, self.data[var][0]))
+            if parts[0] in rules:
+                ops.append((var, vals[0]))
 
         if self.args:
             arg = ' '.join(self.args)
@@ -1956,7 +2402,7 @@ class ConfigAdd(Command):
 
         # We don't have transactions really, but making sure the HTTPD
         # is idle (aside from this request) will definitely help.
-        with BLOCK_HTTPD_LOCK, Idle_HTTPD():
+        with httpd.BLOCK_HTTPD_LOCK, httpd.Idle_HTTPD():
             updated = {}
             for path, value in ops:
                 value = value.strip()
@@ -1967,7 +2413,7 @@ class ConfigAdd(Command):
                 updated[path] = value
 
         if updated:
-            self._background_save(config=True)
+            config.schedule_save(self.session)
 
         return self._success(_('Updated your settings'), result=updated)
 
@@ -1983,7 +2429,7 @@ class ConfigUnset(Command):
     IS_USER_ACTIVITY = True
 
     def command(self):
-        from mailpile.httpd import BLOCK_HTTPD_LOCK, Idle_HTTPD
+        httpd = _httpd()
 
         session, config = self.session, self.session.config
 
@@ -1991,21 +2437,25 @@ class ConfigUnset(Command):
             return self._error(_('In lockdown, doing nothing.'))
 
         def unset(cfg, key):
-            if isinstance(cfg[key], dict):
-                if '_any' in cfg[key].rules:
-                    for skey in cfg[key].keys():
-                        del cfg[key][skey]
+            # Walk the tree with an explicit stack instead of recursing
+            stack = [(cfg, key)]
+            while stack:
+                cfg, key = stack.pop()
+                val = cfg[key]
+                if isinstance(val, dict):
+                    if '_any' in val.rules:
+                        for skey in val.keys():
+                            del val[skey]
+                    else:
+                        stack.extend((val, skey) for skey in val.keys())
+                elif isinstance(val, list):
+                    cfg[key] = []
                 else:
-                    for skey in cfg[key].keys():
-                        unset(cfg[key], skey)
-            elif isinstance(cfg[key], list):
-                cfg[key] = []
-            else:
-                del cfg[key]
+                    del cfg[key]
 
         # We don't have transactions really, but making sure the HTTPD
         # is idle (aside from this request) will definitely help.
-        with BLOCK_HTTPD_LOCK, Idle_HTTPD():
+        with httpd.BLOCK_HTTPD_LOCK, httpd.Idle_HTTPD():
             updated = []
             vlist = list(self.args) + (self.data.get('var', None) or [])
             for v in vlist:
@@ -2013,7 +2463,7 @@ class ConfigUnset(Command):
                 unset(cfg, vn)
 
         if updated:
-            self._background_save(config=True)
+            config.schedule_save(self.session)
 
         return self._success(_('Reset to default values'), result=updated)
 
@@ -2038,27 +2488,29 @@ class ConfigPrint(Command):
 
     def _maybe_all(self, list_all, data, key_types, recurse, sanitize):
         if isinstance(data, (dict, list)) and list_all:
+            allowed = set(key_types)
+            data_key_types = data.key_types
             rv = {}
             for key in data.all_keys():
-                if [t for t in data.key_types(key) if t not in key_types]:
+                if not allowed.issuperset(data_key_types(key)):
                     # Silently omit things that are considered sensitive
                     continue
-                rv[key] = data[key]
-                if hasattr(rv[key], 'all_keys'):
+                val = data[key]
+                if hasattr(val, 'all_keys'):
                     if recurse:
-                        rv[key] = self._maybe_all(True, rv[key], key_types,
-                                                  recurse, sanitize)
+                        val = self._maybe_all(True, val, key_types,
+                                              recurse, sanitize)
+                    elif 'name' in val:
+                        val = '{ ..(%s).. }' % val['name']
+                    elif 'description' in val:
+                        val = '{ ..(%s).. }' % val['description']
+                    elif 'host' in val:
+                        val = '{ ..(%s).. }' % val['host']
                     else:
-                        if 'name' in rv[key]:
-                            rv[key] = '{ ..(%s).. }' % rv[key]['name']
-                        elif 'description' in rv[key]:
-                            rv[key] = '{ ..(%s).. }' % rv[key]['description']
-                        elif 'host' in rv[key]:
-                            rv[key] = '{ ..(%s).. }' % rv[key]['host']
-                        else:
-                            rv[key] = '{ ... }'
+                        val = '{ ... }'
                 elif sanitize and key.lower()[:4] in ('pass', 'secr'):
-                    rv[key] = '(SUPPRESSED)'
+                    val = '(SUPPRESSED)'
+                rv[key] = val
             return rv
         return data
 
@@ -2123,28 +2575,27 @@ class AddMailboxes(Command):
     MAX_PATHS = 50000
 
     def command(self):
-        from mailpile.httpd import BLOCK_HTTPD_LOCK, Idle_HTTPD
+        httpd = _httpd()
 
         session, config = self.session, self.session.config
         adding = []
-        existing = config.sys.mailbox
-        paths = list(self.args)
+        existing = set(config.sys.mailbox)
+        paths = collections.deque(self.args)
 
         if config.sys.lockdown:
             return self._error(_('In lockdown, doing nothing.'))
 
         try:
             while paths:
-                raw_fn = paths.pop(0)
-                fn = os.path.normpath(os.path.expanduser(raw_fn))
-                fn = os.path.abspath(fn)
+                raw_fn = paths.popleft()
+                fn = os.path.abspath(os.path.expanduser(raw_fn))
                 if raw_fn in existing or fn in existing:
                     session.ui.warning('Already in the pile: %s' % raw_fn)
                 elif raw_fn.startswith("imap://"):
                     adding.append(raw_fn)
                 elif IsMailbox(fn, config):
                     adding.append(raw_fn)
-                elif vfs.exists(fn) and vfs.isdir(fn):
+                elif vfs.isdir(fn):
                         session.ui.mark('Scanning %s for mailboxes' % fn)
                         try:
                             for f in [f for f in os.listdir(fn)
@@ -2165,11 +2616,11 @@ class AddMailboxes(Command):
         added = {}
         # We don't have transactions really, but making sure the HTTPD
         # is idle (aside from this request) will definitely help.
-        with BLOCK_HTTPD_LOCK, Idle_HTTPD():
+        with httpd.BLOCK_HTTPD_LOCK, httpd.Idle_HTTPD():
             for arg in adding:
                 added[config.sys.mailbox.append(arg)] = arg
         if added:
-            self._background_save(config=True)
+            config.schedule_save(self.session)
             return self._success(_('Added %d mailboxes') % len(added),
                                  result={'added': added})
         else:
@@ -2210,15 +2661,17 @@ class Output(Command):
     HTTP_AUTH_REQUIRED = False
     IS_USER_ACTIVITY = False
     LOG_NOTHING = True
+    MAX_AGE = 364 * 24 * 3600  # A long time!
 
     def etag_data(self):
         return self.get_render_mode()
 
     def max_age(self):
-        return 364 * 24 * 3600  # A long time!
+        return self.MAX_AGE
 
     def get_render_mode(self):
-        return self.args and self.args[0] or self.session.ui.render_mode
+        args = self.args
+        return (args and args[0]) or self.session.ui.render_mode
 
     def command(self):
         m = self.session.ui.render_mode = self.get_render_mode()
@@ -2307,7 +2760,6 @@ class Quit(Command):
         mailpile.util.QUITTING = True
         self._background_save(index=True, config=True, wait=True)
         try:
-            import signal
             os.kill(mailpile.util.MAIN_PID, signal.SIGINT)
         except:
             def exiter():
@@ -2410,11 +2862,22 @@ class Help(Command):
             last_rank = None
             cmds = self.result['commands']
             width = self.result.get('width', 8)
-            ckeys = cmds.keys()
-            ckeys.sort(key=lambda k: (cmds[k][3], cmds[k][0]))
+            # Decorate once, so the loop below needs no further lookups;
+            # the key also breaks ties, keeping the output stable.
+            ordered = sorted((info[3], info[0], k, info)
+                             for k, info in cmds.iteritems())
             arg_width = min(50, max(14, self.session.ui.term.max_width()-70))
-            for c in ckeys:
-                cmd, args, explanation, rank = cmds[c]
+
+            # The prefix column is always two characters wide, so all
+            # three line formats can be built up front.
+            fmt = '  %%s%%-%d.%ds' % (width, width)
+            fmt_short = fmt + ' %%-%d.%ds %%s' % (arg_width, arg_width)
+            pad = 2 + width + 3 + arg_width
+            fmt_long = fmt + ' %%s\n%s %%s' % (' ' * pad)
+            fmt_bare = fmt + ' %s %s '
+
+            for _rank, _cmd, c, info in ordered:
+                cmd, args, explanation, rank = info
                 if not rank or not cmd:
                     continue
                 if last_rank and int(rank / 10) != last_rank:
@@ -2424,19 +2887,17 @@ class Help(Command):
                     c = '  '
                 else:
                     c = '%s|' % c[0]
-                fmt = '  %%s%%-%d.%ds' % (width, width)
                 if explanation:
                     if len(args or '') <= arg_width:
-                        fmt += ' %%-%d.%ds %%s' % (arg_width, arg_width)
+                        fmt = fmt_short
                     else:
-                        pad = len(c) + width + 3 + arg_width
-                        fmt += ' %%s\n%s %%s' % (' ' * pad)
+                        fmt = fmt_long
                 else:
                     explanation = ''
-                    fmt += ' %s %s '
+                    fmt = fmt_bare
                 text.append(fmt % (c, cmd.replace('=', ''),
                                    args and ('%s' % (args, )) or '',
-                                   (explanation.splitlines() or [''])[0]))
+                                   explanation.partition('\n')[0]))
             if self.result.get('tags'):
                 text.extend([
                     '',
@@ -2462,42 +2923,30 @@ class Help(Command):
         self.session.ui.reset_marks(quiet=True)
         if self.args:
             command = self.args[0]
-            for cls in COMMANDS:
-                name = cls.SYNOPSIS[1] or cls.SYNOPSIS[2]
-                width = len(name or '')
-                if name and name == command:
-                    order = 1
-                    cmd_list = {'_main': (name, cls.SYNOPSIS[3],
-                                          cls.__doc__, order)}
-                    subs = [c for c in COMMANDS
-                            if (c.SYNOPSIS[1] or c.SYNOPSIS[2] or ''
-                                ).startswith(name + '/')]
-                    for scls in sorted(subs):
-                        sc, scmd, surl, ssynopsis = scls.SYNOPSIS[:4]
-                        order += 1
-                        cmd_list['_%s' % scmd] = (scmd, ssynopsis,
-                                                  scls.__doc__, order)
-                        width = max(len(scmd or surl), width)
-                    return self._success(_('Displayed help'), result={
-                        'pre': cls.__doc__,
-                        'commands': cmd_list,
-                        'width': width
-                    })
+            cmd_maps = _command_maps()
+            cls = cmd_maps[3].get(command)
+            if cls is not None:
+                name = command
+                width = len(name)
+                order = 1
+                cmd_list = {'_main': (name, cls.SYNOPSIS[3],
+                                      cls.__doc__, order)}
+                subs = cmd_maps[2].get(name, [])
+                for scls in sorted(subs):
+                    sc, scmd, surl, ssynopsis = scls.SYNOPSIS[:4]
+                    order += 1
+                    cmd_list['_%s' % scmd] = (scmd, ssynopsis,
+                                              scls.__doc__, order)
+                    width = max(len(scmd or surl), width)
+                return self._success(_('Displayed help'), result={
+                    'pre': cls.__doc__,
+                    'commands': cmd_list,
+                    'width': width
+                })
             return self._error(_('Unknown command'))
 
         else:
-            cmd_list = {}
-            count = 0
-            for grp in COMMAND_GROUPS:
-                count += 10
-                for cls in COMMANDS:
-                    if cls.CONFIG_REQUIRED and not config.loaded_config:
-                        continue
-                    c, name, url, synopsis = cls.SYNOPSIS[:4]
-                    if cls.ORDER[0] == grp and '/' not in (name or ''):
-                        cmd_list[c or '_%s' % name] = (name, synopsis,
-                                                       cls.__doc__,
-                                                       count + cls.ORDER[1])
+            cmd_list = dict(self._command_table(bool(config.loaded_config)))
             if config.loaded_config:
                 tags = GetCommand('tags')(self.session).run()
             else:
@@ -2512,6 +2961,28 @@ class Help(Command):
                 'index': index
             })
 
+    # (loaded_config, len(COMMANDS)) -> table of top-level commands
+    _CMD_TABLE_CACHE = {}
+
+    @classmethod
+    def _command_table(cls, loaded_config):
+        key = (loaded_config, len(COMMANDS))
+        if key not in cls._CMD_TABLE_CACHE:
+            cmd_list = {}
+            count = 0
+            for grp in COMMAND_GROUPS:
+                count += 10
+                for ccls in COMMANDS:
+                    if ccls.CONFIG_REQUIRED and not loaded_config:
+                        continue
+                    c, name, url, synopsis = ccls.SYNOPSIS[:4]
+                    if ccls.ORDER[0] == grp and '/' not in (name or ''):
+                        cmd_list[c or '_%s' % name] = (name, synopsis,
+                                                       ccls.__doc__,
+                                                       count + ccls.ORDER[1])
+            cls._CMD_TABLE_CACHE[key] = cmd_list
+        return cls._CMD_TABLE_CACHE[key]
+
     def _starting(self):
         pass
 
@@ -2529,10 +3000,27 @@ class HelpVars(Help):
     CONFIG_REQUIRED = False
     IS_USER_ACTIVITY = True
 
+    # Rule tables are stable once plugins are loaded; cache by table and size
+    _VARS_CACHE = {}
+
     def command(self):
         config = self.session.config.rules
-        result = []
         categories = ["sys", "prefs", "profiles"]
+        key = (id(config),) + tuple(
+            len(config[c][2]) if (c in config and
+                                  isinstance(config[c][2], dict)) else -1
+            for c in categories)
+        result = self._VARS_CACHE.get(key)
+        if result is None:
+            result = self._variables(config, categories)
+            if len(self._VARS_CACHE) > 16:
+                self._VARS_CACHE.clear()
+            self._VARS_CACHE[key] = result
+        return self._success(_('Displayed variables'),
+                             result={'variables': result})
+
+    def _variables(self, config, categories):
+        result = []
         for cat in categories:
             variables = []
             what = config[cat]
@@ -2550,8 +3038,7 @@ class HelpVars(Help):
                 'variables': variables
             })
         result.sort(key=lambda k: config[k['category']][0])
-        return self._success(_('Displayed variables'),
-                             result={'variables': result})
+        return result
 
 
 class HelpSplash(Help):
@@ -2585,11 +3072,37 @@ class HelpSplash(Help):
         })
 
 
+# Lookup tables derived from COMMANDS:
+#    (len(COMMANDS), by_name, subcommands, by_primary_name)
+_COMMAND_MAPS = (0, {}, {}, {})
+
+
+def _command_maps():
+    """Return the name, sub-command and help lookup tables for COMMANDS."""
+    global _COMMAND_MAPS
+    # Plugins only ever append to COMMANDS, so its length tells us
+    # whether the tables need rebuilding.
+    if _COMMAND_MAPS[0] != len(COMMANDS):
+        matches, subcommands, by_primary = {}, {}, {}
+        for cls in COMMANDS:
+            for name in set(cls.SYNOPSIS[:3]):
+                if name:
+                    matches.setdefault(name, []).append(cls)
+            primary = cls.SYNOPSIS[1] or cls.SYNOPSIS[2]
+            if primary:
+                by_primary.setdefault(primary, cls)
+            path = (primary or '').split('/')
+            for i in range(1, len(path)):
+                subcommands.setdefault('/'.join(path[:i]), []).append(cls)
+        # Ambiguous names don't map to any command
+        by_name = dict((n, m[0]) for n, m in matches.iteritems()
+                       if len(m) == 1)
+        _COMMAND_MAPS = (len(COMMANDS), by_name, subcommands, by_primary)
+    return _COMMAND_MAPS
+
+
 def GetCommand(name):
-    match = [c for c in COMMANDS if name in c.SYNOPSIS[:3]]
-    if len(match) == 1:
-        return match[0]
-    return None
+    return _command_maps()[1].get(name)
 
 
 def Action(session, opt, arg, data=None):
@@ -1257,6 +1257,7 @@ class ConfigManager(ConfigDict):
         self._mbox_cache = []
         self._running = {}
         self._lock = ConfigRLock()
+        self._save_timer = None
         self.loaded_config = False
 
         def cache_debug(msg):
@@ -1508,7 +1509,33 @@ class ConfigManager(ConfigDict):
         with self._lock:
             self._unlocked_save(*args, **kwargs)
 
+    def schedule_save(self, session, delay=0.25):
+        """
+        Save the config in the background, once things have been quiet
+        for a moment. This lets a burst of changes share a single save.
+        """
+        def queue_save():
+            self.save_worker.add_unique_task(session, 'Save config',
+                                             lambda: self.save(session))
+
+        # Bursts of changes only really come from the web UI; without
+        # it there is nothing to wait for, so just queue the save.
+        if self.http_worker is None:
+            return queue_save()
+
+        with self._lock:
+            if self._save_timer is not None:
+                self._save_timer.cancel()
+            self._save_timer = threading.Timer(delay, queue_save)
+            self._save_timer.daemon = True
+            self._save_timer.start()
+
     def _unlocked_save(self, session=None):
+        # Whatever was scheduled is covered by this save.
+        if self._save_timer is not None:
+            self._save_timer.cancel()
+            self._save_timer = None
+
         if not self.loaded_config:
             return
 
@@ -2269,6 +2296,12 @@ class ConfigManager(ConfigDict):
         # Flush the mailbox cache (queues save worker jobs)
         config.flush_mbox_cache(config.background, clear=True)
 
+        # Write out any config changes still waiting on schedule_save(),
+        # so they are not lost with the timer when we exit.
+        with config._lock:
+            if config._save_timer is not None:
+                config._unlocked_save(config.background)
+
         # Handle the save worker last, once all the others are
         # no longer feeding it new things to do.
         with config._lock:
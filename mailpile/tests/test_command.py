@@ -1,9 +1,12 @@
 import unittest
 import os
+import shutil
+import tempfile
 from mock import patch
 
 import mailpile
 from mailpile.commands import Action as action
+from mailpile.commands import CatFile, Command, COMMANDS, GetCommand
 from mailpile.tests import MailPileUnittest
 
 
@@ -157,5 +160,81 @@ class TestGPG(MailPileUnittest):
         pass
 
 
+class TestCommandLookup(MailPileUnittest):
+    def _get_command(self, name):
+        # The original linear scan, for comparison
+        match = [c for c in COMMANDS if name in c.SYNOPSIS[:3]]
+        return match[0] if len(match) == 1 else None
+
+    def test_get_command(self):
+        self.assertEqual(GetCommand('search').SYNOPSIS[1], 'search')
+        self.assertEqual(GetCommand('settings/set').SYNOPSIS[1], 'set')
+        self.assertEqual(GetCommand('no-such-command'), None)
+        names = set(n for c in COMMANDS for n in c.SYNOPSIS[:3] if n)
+        for name in names:
+            self.assertEqual(GetCommand(name), self._get_command(name))
+
+    def test_get_command_added_later(self):
+        class LateCommand(Command):
+            """Registered after the lookup tables were built"""
+            SYNOPSIS = (None, 'late', 'late/command', None)
+
+        class LateSubCommand(Command):
+            """A sub-command of the above"""
+            SYNOPSIS = (None, 'late/sub', 'late/sub', None)
+
+        self.assertEqual(GetCommand('late'), None)
+        COMMANDS.extend([LateCommand, LateSubCommand])
+        try:
+            self.assertEqual(GetCommand('late'), LateCommand)
+            self.assertEqual(GetCommand('late/command'), LateCommand)
+            self.assertEqual(GetCommand('late/sub'), LateSubCommand)
+            res = self.mp.help('late')
+            self.assertEqual(res.result['pre'], LateCommand.__doc__)
+            self.assertEqual(sorted(res.result['commands'].keys()),
+                             ['_late/sub', '_main'])
+        finally:
+            COMMANDS.remove(LateCommand)
+            COMMANDS.remove(LateSubCommand)
+        self.assertEqual(GetCommand('late'), None)
+
+
+class TestCatFile(MailPileUnittest):
+    PLAIN = 'Hello world\n' * 10 + 'no newline at the end'
+    PGP = ('x' * 20 + '\n'
+           '-----BEGIN PGP MESSAGE-----\n\nhQEMA\n-----END PGP MESSAGE-----\n'
+           'after\n')
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _cat(self, data, fast=True):
+        src = os.path.join(self.tmpdir, 'src')
+        dst = tempfile.mktemp(dir=self.tmpdir)
+        with open(src, 'wb') as fd:
+            fd.write(data)
+        cmd = CatFile(self.session, arg=[src, '>' + dst])
+        cmd.COPY_CHUNK = 16  # Small, so markers straddle chunks
+        if not fast:
+            cmd._is_plaintext = lambda fd: False
+        self.assertEqual(cmd.run().as_dict()['status'], 'success')
+        with open(dst, 'rb') as fd:
+            return fd.read()
+
+    def test_cat_plaintext_to_file(self):
+        self.assertEqual(self._cat(self.PLAIN), self.PLAIN)
+        self.assertEqual(self._cat(self.PLAIN),
+                         self._cat(self.PLAIN, fast=False))
+
+    def test_cat_embedded_pgp_to_file(self):
+        # The marker starts past the first chunk and spans two of them
+        self.assertEqual(self._cat(self.PGP),
+                         self._cat(self.PGP, fast=False))
+        self.assertNotEqual(self._cat(self.PGP), self.PGP)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,6 +1,11 @@
 import unittest
 import os
+import shutil
+import tempfile
 import mailpile
+import mailpile.app
+import mailpile.defaults
+import mailpile.ui
 
 from nose.tools import raises
 from mailpile.tests import MailPileUnittest
@@ -284,3 +289,26 @@ class TestConfig(MailPileUnittest):
 
         for i in invalid_emails:
             self.assertRaises(ValueError, lambda: mailpile.config._EmailCheck(i))
+
+    #
+    # Settings changed just before shutdown must still reach the disk
+    #
+    def test_set_survives_stop_workers(self):
+        def load(workdir):
+            config = mailpile.app.ConfigManager(
+                workdir=workdir, rules=mailpile.defaults.CONFIG_RULES)
+            session = mailpile.ui.Session(config)
+            session.ui = mailpile.ui.SilentInteraction(config)
+            config.load(session)
+            return config, session
+
+        workdir = tempfile.mkdtemp()
+        try:
+            config, session = load(workdir)
+            mailpile.Mailpile(session=session).set('prefs.num_results=7')
+            config.stop_workers()
+
+            config, session = load(workdir)
+            self.assertEqual(config.prefs.num_results, 7)
+        finally:
+            shutil.rmtree(workdir)
@@ -1,7 +1,9 @@
 import unittest
 from nose.tools import assert_equal, assert_less
 
-from mailpile.tests import get_shared_mailpile
+from mailpile.commands import SearchResults
+from mailpile.tests import get_shared_mailpile, MailPileUnittest
+from mailpile.util import b36
 
 
 def checkSearch(query, expected_count=1):
@@ -48,3 +50,37 @@ def test_generator():
 
     # Test that we do not crash when searching for a non-existant tag.
     yield checkSearch(['in:doesnotexist'], 0)
+
+
+class TestSearchResults(MailPileUnittest):
+    def _fake_info(self, date, replies=''):
+        idx = self.config.index
+        info = list(idx.get_msg_at_idx_pos(1))
+        info[idx.MSG_DATE] = b36(date)
+        info[idx.MSG_REPLIES] = replies
+        return info
+
+    def test_thread_sorted_by_date(self):
+        sr = SearchResults(self.session, self.config.index,
+                           results=[1], num=1)
+        sr._msg_info_cache.update({
+            't': self._fake_info(100, ',c,a,d,b,'),
+            'a': self._fake_info(300),
+            'b': self._fake_info(100),
+            'c': self._fake_info(200),
+            'd': self._fake_info(200),
+        })
+        # Oldest first; messages with the same date keep their order
+        assert_equal(sr._thread('t'), ['b', 'c', 'd', 'a'])
+
+    def test_last_result_thread_expanded(self):
+        # Message 0 is the only (and so last) result on the page, and
+        # starts a thread containing message 3.
+        idx = self.config.index
+        self.assertEqual(idx.get_msg_at_idx_pos(0)[idx.MSG_REPLIES], ',3,')
+        sr = SearchResults(self.session, idx,
+                           results=[0], num=1, full_threads=True)
+        self.assertIn('3', sr['data']['metadata'])
+        sr = SearchResults(self.session, idx,
+                           results=[0], num=1, full_threads=False)
+        self.assertNotIn('3', sr['data']['metadata'])
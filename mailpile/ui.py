@@ -37,6 +37,18 @@ class SuppressHtmlOutput(Exception):
     pass
 
 
+class NoFailEncoder(JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, (list, dict, str, unicode,
+                            int, float, bool, type(None))):
+            return JSONEncoder.default(self, obj)
+        else:
+            return json_helper(obj)
+
+# Encoders are stateless between calls, so we build this one just once.
+JSON_RENDERER = NoFailEncoder(indent=1, sort_keys=True, allow_nan=False)
+
+
 def default_dict(*args):
     d = defaultdict(str)
     for arg in args:
@@ -440,16 +452,7 @@ class UserInteraction:
     # Rendering helpers for templating and such
     def render_json(self, data):
         """Render data as JSON"""
-        class NoFailEncoder(JSONEncoder):
-            def default(self, obj):
-                if isinstance(obj, (list, dict, str, unicode,
-                                    int, float, bool, type(None))):
-                    return JSONEncoder.default(self, obj)
-                else:
-                    return json_helper(obj)
-
-        return json.dumps(data, indent=1, cls=NoFailEncoder,
-                                sort_keys=True, allow_nan=False)
+        return JSON_RENDERER.encode(data)
 
     def _web_template(self, config, tpl_names, elems=None):
         env = config.jinja_env